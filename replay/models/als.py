@@ -136,8 +136,16 @@ class ALSWrap(Recommender, ItemVectorModel):
                 .select(self.query_column, self.item_column, self.rating_column)
             )
 
+        pairs = queries.crossJoin(items)
+        if filter_seen_items and dataset is not None:
+            # seen items are filtered out anyway, so there is no need to score them
+            pairs = pairs.join(
+                sf.broadcast(dataset.interactions.select(self.query_column, self.item_column)),
+                on=[self.query_column, self.item_column],
+                how="left_anti",
+            )
         return self._predict_pairs(
-            pairs=queries.crossJoin(items).withColumn(self.rating_column, sf.lit(1)),
+            pairs=pairs.withColumn(self.rating_column, sf.lit(1)),
             dataset=dataset,
         )
 
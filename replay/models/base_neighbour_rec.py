@@ -80,10 +80,15 @@ class NeighbourRec(Recommender, ANNMixin, ABC):
                 "interactions is not provided, but it is required for prediction"
             )
 
+        interactions = dataset.interactions.select(self.query_column, self.item_column)
+        similarity = self.similarity.select(
+            "item_idx_one", "item_idx_two", self.similarity_metric
+        )
         recs = (
-            dataset.interactions.join(queries, how="inner", on=self.query_column)
+            queries.select(self.query_column)
+            .join(interactions, how="inner", on=self.query_column)
             .join(
-                self.similarity,
+                sf.broadcast(similarity),
                 how="inner",
                 on=sf.col(self.item_column) == sf.col("item_idx_one"),
             )
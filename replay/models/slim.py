@@ -1,19 +1,114 @@
-from typing import Any, Dict, Optional
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
 
 import numpy as np
 import pandas as pd
-from scipy.sparse import csc_matrix
-from sklearn.linear_model import ElasticNet
+from scipy.sparse import csc_matrix, csr_matrix
+# pylint: disable=no-name-in-module
+from sklearn.linear_model._cd_fast import enet_coordinate_descent_gram
+from sklearn.utils import check_random_state
 
 from replay.data import Dataset
 from .base_neighbour_rec import NeighbourRec
 from .extensions.ann.index_builders.base_index_builder import IndexBuilder
-from replay.utils import PYSPARK_AVAILABLE
+from replay.utils import PYSPARK_AVAILABLE, SparkDataFrame
 from replay.utils.session_handler import State
 from replay.utils.spark_utils import spark_to_pandas
 
 if PYSPARK_AVAILABLE:
-    from pyspark.sql import types as st
+    from pyspark import StorageLevel
+
+_MAX_ITER = 5000
+_TOL = 1e-4
+_BUCKET_SIZE = 128
+
+
+# pylint: disable=too-many-arguments
+def _slim_column(
+    gram: np.ndarray,
+    column_values: np.ndarray,
+    idx: int,
+    l1_reg: float,
+    l2_reg: float,
+    seed: Optional[int],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit one column of the similarity matrix with ElasticNet coordinate descent
+    on the Gram matrix, excluding the item itself from the regressors.
+
+    :param gram: Gram matrix of the query-item interactions matrix
+    :param column_values: non-zero values of the item column
+    :param idx: item index
+    :param l1_reg: l1 regularization multiplied by the number of queries
+    :param l2_reg: l2 regularization multiplied by the number of queries
+    :param seed: random seed
+    :return: indices and values of the positive coefficients
+    """
+    column_gram = gram[idx].copy()
+    # with a huge negative correlation to the target the positive coefficient
+    # of the item itself stays zero, so the Gram matrix is shared unchanged
+    column_gram[idx] = np.finfo(gram.dtype).min
+
+    coef = np.zeros(gram.shape[0], dtype=gram.dtype)
+    # only the norm of the target column is used by the solver
+    enet_coordinate_descent_gram(
+        coef,
+        l1_reg,
+        l2_reg,
+        gram,
+        column_gram,
+        column_values,
+        _MAX_ITER,
+        _TOL,
+        check_random_state(seed),
+        True,
+        True,
+    )
+
+    good_idx = np.flatnonzero(coef)
+    good_values = coef[good_idx]
+    return good_idx, good_values
+
+
+def _slim_similarity(
+    interactions_matrix: csc_matrix,
+    l1_reg: float,
+    l2_reg: float,
+    seed: Optional[int],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fit the similarity matrix columns of the items with interactions
+    in parallel threads sharing one Gram matrix.
+
+    :param interactions_matrix: query-item interactions matrix
+    :param l1_reg: l1 regularization multiplied by the number of queries
+    :param l2_reg: l2 regularization multiplied by the number of queries
+    :param seed: random seed
+    :return: similar item indices, item indices and similarity values
+    """
+    gram = (interactions_matrix.T @ interactions_matrix).toarray()
+    data, indptr = interactions_matrix.data, interactions_matrix.indptr
+    items = np.flatnonzero(np.diff(indptr))
+
+    def fit_bucket(bucket: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        columns = [
+            _slim_column(gram, data[indptr[idx] : indptr[idx + 1]], idx, l1_reg, l2_reg, seed)
+            for idx in bucket
+        ]
+        return (
+            np.concatenate([good_idx for good_idx, _ in columns]),
+            np.repeat(bucket, [good_idx.size for good_idx, _ in columns]),
+            np.concatenate([good_values for _, good_values in columns]),
+        )
+
+    # coordinate descent releases GIL, so the buckets of columns are fitted concurrently
+    buckets = np.array_split(items, -(-items.size // _BUCKET_SIZE))
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = list(executor.map(fit_bucket, buckets))
+
+    items_one, items_two, similarities = (np.concatenate(arrays) for arrays in zip(*results))
+    return items_one, items_two, similarities
 
 
 # pylint: disable=too-many-ancestors, too-many-instance-attributes
@@ -30,6 +125,9 @@ class SLIM(NeighbourRec):
         "beta": {"type": "loguniform", "args": [1e-6, 5]},
         "lambda_": {"type": "loguniform", "args": [1e-6, 2]},
     }
+    # predict with sparse matrix product on the driver up to this number of query-item pairs
+    _driver_predict_max_pairs: int = 10**7
+    _similarity_matrix: Optional[csc_matrix] = None
 
     # pylint: disable=R0913
     def __init__(
@@ -81,59 +179,105 @@ class SLIM(NeighbourRec):
         pandas_interactions = spark_to_pandas(interactions, self.allow_collect_to_master)
         interactions_matrix = csc_matrix(
             (
-                pandas_interactions[self.rating_column],
+                pandas_interactions[self.rating_column].astype(np.float32),
                 (
-                    pandas_interactions[self.query_column],
-                    pandas_interactions[self.item_column],
+                    pandas_interactions[self.query_column].astype(np.int32),
+                    pandas_interactions[self.item_column].astype(np.int32),
                 ),
             ),
             shape=(self._query_dim, self._item_dim),
         )
-        similarity = (
-            State()
-            .session.createDataFrame(pandas_interactions[self.item_column], st.IntegerType())
-            .withColumnRenamed("value", "item_idx_one")
+
+        # the same scaling of regularization as in sklearn ElasticNet
+        items_one, items_two, similarities = _slim_similarity(
+            interactions_matrix,
+            l1_reg=self.lambda_ * self._query_dim,
+            l2_reg=self.beta * self._query_dim,
+            seed=self.seed,
+        )
+        similarity_pd = pd.DataFrame(
+            {
+                "item_idx_one": items_one.astype(np.int32),
+                "item_idx_two": items_two.astype(np.int32),
+                "similarity": similarities.astype(np.float64),
+            },
+            copy=False,
+        )
+        self.similarity = State().session.createDataFrame(
+            similarity_pd,
+            schema="item_idx_one int, item_idx_two int, similarity double",
         )
+        self.similarity.persist(StorageLevel.MEMORY_ONLY).count()
+        self._similarity_matrix = csc_matrix(
+            (similarities, (items_one, items_two)),
+            shape=(self._item_dim, self._item_dim),
+        )
+
+    def _clear_cache(self):
+        super()._clear_cache()
+        self._similarity_matrix = None
+
+    def _get_similarity_matrix(self) -> csc_matrix:
+        """
+        :returns: similarity matrix on the driver, built at fit
+            or collected from ``similarity`` after loading,
+            rows are ``item_idx_one`` and columns are ``item_idx_two``
+        """
+        if self._similarity_matrix is None:
+            similarity = spark_to_pandas(self.similarity, self.allow_collect_to_master)
+            self._similarity_matrix = csc_matrix(
+                (
+                    similarity[self.similarity_metric],
+                    (similarity["item_idx_one"], similarity["item_idx_two"]),
+                ),
+                shape=(self._item_dim, self._item_dim),
+            )
+        return self._similarity_matrix
+
+    # pylint: disable=too-many-arguments
+    def _predict(
+        self,
+        dataset: Dataset,
+        k: int,
+        queries: SparkDataFrame,
+        items: SparkDataFrame,
+        filter_seen_items: bool = True,
+    ) -> SparkDataFrame:
+        if dataset is None or queries.count() * items.count() > self._driver_predict_max_pairs:
+            return super()._predict(dataset, k, queries, items, filter_seen_items)
+
+        interactions = dataset.interactions.join(queries, on=self.query_column).select(
+            self.query_column, self.item_column
+        )
+        query_type = interactions.schema[self.query_column].dataType.simpleString()
+        pandas_interactions = spark_to_pandas(interactions, self.allow_collect_to_master)
+        candidates = spark_to_pandas(items, self.allow_collect_to_master)[self.item_column].to_numpy()
 
-        alpha = self.beta + self.lambda_
-        l1_ratio = self.lambda_ / alpha
-
-        regression = ElasticNet(
-            alpha=alpha,
-            l1_ratio=l1_ratio,
-            fit_intercept=False,
-            max_iter=5000,
-            random_state=self.seed,
-            selection="random",
-            positive=True,
+        similarity_matrix = self._get_similarity_matrix()
+        # items unknown to the model have no similar items
+        pandas_interactions = pandas_interactions[
+            pandas_interactions[self.item_column] < similarity_matrix.shape[0]
+        ]
+        candidates = candidates[candidates < similarity_matrix.shape[1]]
+        query_ids, query_rows = np.unique(pandas_interactions[self.query_column], return_inverse=True)
+        queries_matrix = csr_matrix(
+            (
+                np.ones(len(pandas_interactions)),
+                (query_rows, pandas_interactions[self.item_column]),
+            ),
+            shape=(query_ids.size, similarity_matrix.shape[0]),
         )
+        scores = (queries_matrix @ similarity_matrix[:, candidates]).tocoo()
 
-        def slim_column(pandas_df: pd.DataFrame) -> pd.DataFrame:   # pragma: no cover
-            """
-            fit similarity matrix with ElasticNet
-            :param pandas_df: pd.Dataframe
-            :return: pd.Dataframe
-            """
-            idx = int(pandas_df["item_idx_one"][0])
-            column = interactions_matrix[:, idx]
-            column_arr = column.toarray().ravel()
-            interactions_matrix[
-                interactions_matrix[:, idx].nonzero()[0], idx
-            ] = 0
-
-            regression.fit(interactions_matrix, column_arr)
-            interactions_matrix[:, idx] = column
-            good_idx = np.argwhere(regression.coef_ > 0).reshape(-1)
-            good_values = regression.coef_[good_idx]
-            similarity_row = {
-                "item_idx_one": good_idx,
-                "item_idx_two": idx,
-                "similarity": good_values,
-            }
-            return pd.DataFrame(data=similarity_row)
-
-        self.similarity = similarity.groupby("item_idx_one").applyInPandas(
-            slim_column,
-            "item_idx_one int, item_idx_two int, similarity double",
+        recs = pd.DataFrame(
+            {
+                self.query_column: query_ids[scores.row],
+                self.item_column: candidates[scores.col].astype(np.int32),
+                self.rating_column: scores.data.astype(np.float64, copy=False),
+            },
+            copy=False,
+        )
+        return State().session.createDataFrame(
+            recs,
+            schema=f"{self.query_column} {query_type}, {self.item_column} int, {self.rating_column} double",
         )
-        self.similarity.cache().count()
@@ -76,6 +76,19 @@ def test_predict(log, model):
     )
 
 
+@pytest.mark.spark
+def test_predict_on_driver_equals_spark(log, model):
+    dataset = create_dataset(log)
+    model.fit(dataset)
+    recs_driver = model.predict(dataset, k=3).toPandas()
+    model._driver_predict_max_pairs = 0
+    recs_spark = model.predict(dataset, k=3).toPandas()
+    assert np.allclose(
+        recs_driver.sort_values(["user_idx", "item_idx"]).to_numpy(),
+        recs_spark.sort_values(["user_idx", "item_idx"]).to_numpy(),
+    )
+
+
 @pytest.mark.spark
 def test_ann_predict(log, model, model_with_ann):
     dataset = create_dataset(log)